@@ -4,124 +4,229 @@
 
 import os
 import time
+import json
 import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from heapq import nlargest, nsmallest
 from datetime import datetime, timezone
-from typing import Dict, List, Optional
+from operator import itemgetter
+from typing import Dict, List, NamedTuple, Optional
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:  # orjson is optional, fall back to the stdlib parser
+    _json_loads = json.loads
 
 # Constants
 BYBIT_REST = os.getenv("BYBIT_REST", "https://api.bybit.com")
 COINGECKO_REST = os.getenv("COINGECKO_REST", "https://api.coingecko.com/api/v3")
 
 MARKET_CAP_MIN_USD = float(os.getenv("MARKET_CAP_MIN_USD", "100000000"))
+TURNOVER_MIN_USD = float(os.getenv("TURNOVER_MIN_USD", "1000000"))
 REQ_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "15"))
+MAX_WORKERS = int(os.getenv("HTTP_WORKERS", "4"))  # concurrent CoinGecko batches in flight
+CANDIDATE_FACTOR = 4  # Candidates kept per table before the market cap filter, as a multiple of --top
+CACHE_DIR = os.getenv("FUNDING_TRACKER_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "funding_tracker"))
+COINS_LIST_TTL = float(os.getenv("COINS_LIST_TTL", "86400"))  # 24h
 USER_AGENT = "funding-tracker-pro/1.0.0"
 
+# Shared session so every call reuses pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.headers.update({"User-Agent": USER_AGENT})
+# Retries (honouring Retry-After on 429) happen inside the connection pool
+RETRY = Retry(total=3, backoff_factor=1.0, status_forcelist=(429, 500, 502, 503, 504),
+              allowed_methods={"GET"}, respect_retry_after_header=True, raise_on_status=False)
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=RETRY))
+
+class Row(NamedTuple):
+    """One display row: Bybit ticker fields joined with CoinGecko metadata."""
+    symbol: str
+    name: str
+    markPrice: float
+    fundingRate: float
+    marketCapUSD: float
+    turnover24h: float
+
 def _http_get(url: str, params: Optional[dict] = None) -> dict:
-    """Helper for HTTP GET with automatic retry for 429 errors."""
-    for attempt in range(3):
-        try:
-            r = requests.get(url, params=params or {}, headers={"User-Agent": USER_AGENT}, timeout=REQ_TIMEOUT)
-            if r.status_code == 429:
-                wait = (attempt + 1) * 30 # Wait 30s, then 60s
-                print(f"Rate limited (429). Waiting {wait}s...")
-                time.sleep(wait)
-                continue
-            r.raise_for_status()
-            return r.json()
-        except Exception as e:
-            if attempt == 2: raise e
-            time.sleep(2)
-    return {}
-
-def get_coingecko_data(symbols: List[str]) -> Dict[str, dict]:
-    """Fetches market names and caps for multiple symbols using batching."""
+    """Helper for HTTP GET; retries for 429 and 5xx errors are handled by the session adapter."""
+    r = SESSION.get(url, params=params or {}, timeout=REQ_TIMEOUT)
+    r.raise_for_status()
+    return _json_loads(r.content)
+
+def get_coins_list_cached() -> List[dict]:
+    """Return CoinGecko's /coins/list, reusing a copy on disk for COINS_LIST_TTL seconds."""
+    path = os.path.join(CACHE_DIR, "coins_list.json")
+    try:
+        if os.path.getmtime(path) > time.time() - COINS_LIST_TTL:
+            with open(path, "rb") as f:
+                return _json_loads(f.read())
+    except (OSError, ValueError):
+        pass  # Missing or unreadable cache, fetch a fresh copy
+
+    coins_list = _http_get(f"{COINGECKO_REST}/coins/list")
+    if not coins_list:
+        return []  # Never cache an empty or failed response
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Unique temp file, so trackers running side by side never swap in a partial write
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=CACHE_DIR,
+                                         suffix=".tmp", delete=False) as f:
+            json.dump(coins_list, f)
+        os.replace(f.name, path)
+    except OSError as e:
+        print(f"Could not cache CoinGecko coins list: {e}")
+    return coins_list
+
+def get_coingecko_ids() -> Dict[str, List[str]]:
+    """Maps each lowercase symbol to every CoinGecko ID that uses it."""
     print(f"Syncing names and market caps from CoinGecko...")
+    ids_by_symbol = {}
+    for c in get_coins_list_cached():
+        ids_by_symbol.setdefault(c['symbol'].lower(), []).append(c['id'])
+    return ids_by_symbol
+
+def get_coingecko_data(symbols: List[str], ids_by_symbol: Dict[str, List[str]]) -> Dict[str, dict]:
+    """Fetches market names and caps for multiple symbols using batching."""
+    # 1. Collect every CoinGecko ID using a wanted symbol; symbols are not unique
+    # (pegged and bridged tokens reuse them), so the right coin is picked by market cap below
+    wanted = {s.lower() for s in symbols}
+    target_ids = [cid for sym in wanted for cid in ids_by_symbol.get(sym, ())]
     
-    # 1. Map lowercase symbol to CoinGecko ID
-    all_coins = _http_get(f"{COINGECKO_REST}/coins/list")
-    symbol_to_id = {c['symbol'].lower(): c['id'] for c in all_coins}
-    
-    target_ids = list(set(symbol_to_id.get(s.lower()) for s in symbols if symbol_to_id.get(s.lower())))
-    
-    coin_data_map = {}
-    # 2. Batch query (up to 250 IDs per request) CoinGecko allows batching up to 250 IDs per request
-    for i in range(0, len(target_ids), 250):
-        batch = target_ids[i:i+250]
+    def fetch(batch: List[str]) -> List[dict]:
         params = {
             "vs_currency": "usd",
             "ids": ",".join(batch),
             "per_page": 250,
             "page": 1
         }
-        data = _http_get(f"{COINGECKO_REST}/coins/markets", params=params)
-        for coin in data:
-            coin_data_map[coin['symbol'].upper()] = {
-                "name": coin.get('name', 'N/A'),
-                "mcap": coin.get('market_cap') or 0
-            }
-        time.sleep(1.5) # Small delay between batches
+        return _http_get(f"{COINGECKO_REST}/coins/markets", params=params)
+    
+    coin_data_map = {}
+    # 2. Batch query (up to 250 IDs per request) CoinGecko allows batching up to 250 IDs per request
+    # The public rate limit is per minute, so the few batches can be in flight at once
+    batches = [target_ids[i:i+250] for i in range(0, len(target_ids), 250)]
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        for data in pool.map(fetch, batches):
+            for coin in data:
+                sym = coin['symbol'].upper()
+                mcap = coin.get('market_cap') or 0
+                # Keep the largest coin when several share a symbol
+                if sym not in coin_data_map or mcap > coin_data_map[sym]['mcap']:
+                    coin_data_map[sym] = {
+                        "name": coin.get('name', 'N/A'),
+                        "mcap": mcap
+                    }
         
     return coin_data_map
 
+def _funding_rate(t: dict) -> float:
+    """Funding rate of a raw Bybit ticker, 0 when missing."""
+    return float(t.get('fundingRate') or 0)
+
 def bybit_get_tickers() -> List[dict]:
     """Fetch all tickers at once to reduce individual API calls."""
     resp = _http_get(f"{BYBIT_REST}/v5/market/tickers", params={"category": "linear"})
     return resp.get("result", {}).get("list", [])
 
-def display_table(title: str, data: List[dict]):
+# Precompiled row template matching the display_table header
+ROW_FMT = "{:<12} {:<15.15} {:<12.4f} {:<12.6f} {:<18,.0f} {:<12,.0f}".format
+
+def display_table(title: str, data: List[Row]):
     """Helper to print a formatted table with mark price and base name."""
     print(f"\n--- {title} ---")
     header = f"{'SYMBOL':<12} {'NAME':<15} {'MARK PRICE':<12} {'FUNDING':<12} {'MARKET CAP':<18} {'TURNOVER':<12}"
     print(header)
     print("-" * len(header))
     for r in data:
-        print(f"{r['symbol']:<12} {r['name']:<15.15} {r['markPrice']:<12.4f} "
-              f"{r['fundingRate']:<12.6f} {r['marketCapUSD']:<18,.0f} {r['turnover24h']:<12,.0f}")
+        print(ROW_FMT(r.symbol, r.name, r.markPrice, r.fundingRate, r.marketCapUSD, r.turnover24h))
 
 def main():
     parser = argparse.ArgumentParser(description="Bybit Multi-Direction Funding Tracker")
     parser.add_argument("--min-cap", type=float, default=MARKET_CAP_MIN_USD)
+    parser.add_argument("--min-turnover", type=float, default=TURNOVER_MIN_USD)
     parser.add_argument("--top", type=int, default=15)
     args = parser.parse_args()
 
+    # Local alias for the per-ticker conversions below; `or 0` also covers the
+    # empty strings and nulls Bybit sends for fields without a value
+    _float = float
+
     # 1. Get all ticker data (Includes Funding Rate & Prices in one go)
     tickers = bybit_get_tickers()
     usdt_pairs = [t for t in tickers if t['symbol'].endswith('USDT')]
     
-    # 2. Get CoinGecko Metadata (Names & Market Caps)
-    base_symbols = [t['symbol'].replace('USDT', '') for t in usdt_pairs]
-    cg_metadata = get_coingecko_data(base_symbols)
+    # Only the two tails of the funding distribution can make it into the tables,
+    # so shortlist them (with headroom for the market cap filter) before CoinGecko
+    shortlist = args.top * CANDIDATE_FACTOR
+    cg_ids = get_coingecko_ids()
+    cg_metadata = {}
+    looked_up = set()
+    
+    def above_cap(tail: List[dict]) -> int:
+        return sum(cg_metadata.get(t['symbol'][:-4], {}).get('mcap', 0) >= args.min_cap for t in tail)
+    
+    while True:
+        if len(usdt_pairs) > 2 * shortlist:
+            pos_tail = nlargest(shortlist, usdt_pairs, key=_funding_rate)
+            neg_tail = nsmallest(shortlist, usdt_pairs, key=_funding_rate)
+            # Tied rates can put the same ticker in both tails, so dedupe by symbol
+            candidates = list({t['symbol']: t for t in pos_tail + neg_tail}.values())
+        else:
+            pos_tail = neg_tail = candidates = usdt_pairs
+        
+        # 2. Get CoinGecko Metadata (Names & Market Caps) for bases not looked up yet;
+        # illiquid pairs are skipped and fall back to the N/A defaults below
+        base_symbols = [t['symbol'][:-4] for t in candidates if t['symbol'][:-4] not in looked_up
+                        and _float(t.get('turnover24h') or 0) >= args.min_turnover]
+        if base_symbols:
+            cg_metadata.update(get_coingecko_data(base_symbols, cg_ids))
+            looked_up.update(base_symbols)
+        
+        if candidates is usdt_pairs:
+            break
+        # Stop once each tail keeps enough pairs above the market cap floor
+        if above_cap(pos_tail) >= args.top and above_cap(neg_tail) >= args.top:
+            break
+        shortlist *= 2
+        print(f"Too few candidates above the market cap floor, widening shortlist to {shortlist} per side...")
     
     processed_list = []
-    for t in usdt_pairs:
+    for t in candidates:
         symbol = t['symbol']
-        base = symbol.replace('USDT', '')
+        base = symbol[:-4]
         meta = cg_metadata.get(base, {"name": "N/A", "mcap": 0})
         
         # Filter by market cap
         if meta['mcap'] < args.min_cap:
             continue
             
-        processed_list.append({
-            "symbol": symbol,
-            "name": meta['name'],
-            "markPrice": float(t.get('markPrice', 0)), # Fetched from Bybit ticker
-            "fundingRate": float(t.get('fundingRate', 0)),
-            "marketCapUSD": meta['mcap'],
-            "turnover24h": float(t.get('turnover24h', 0))
-        })
-
-    # 3. Sort Results
+        funding_rate = _float(t.get('fundingRate') or 0)
+        # Keep the rate up front so ranking compares plain floats
+        processed_list.append((funding_rate, Row(
+            symbol=symbol,
+            name=meta['name'],
+            markPrice=_float(t.get('markPrice') or 0), # Fetched from Bybit ticker
+            fundingRate=funding_rate,
+            marketCapUSD=meta['mcap'],
+            turnover24h=_float(t.get('turnover24h') or 0)
+        )))
+
+    # 3. Pick the top rows of each tail (partial sort, O(N log k))
+    key = itemgetter(0)
     # Top Positive (Highest first)
-    pos_funding = sorted(processed_list, key=lambda x: x["fundingRate"], reverse=True)
+    pos_funding = [row for _, row in nlargest(args.top, processed_list, key=key)]
     # Top Negative (Most negative first)
-    neg_funding = sorted(processed_list, key=lambda x: x["fundingRate"])
+    neg_funding = [row for _, row in nsmallest(args.top, processed_list, key=key)]
 
     # 4. Output Tables
-    display_table("HIGHEST POSITIVE FUNDING", pos_funding[:args.top])
-    display_table("MOST NEGATIVE FUNDING", neg_funding[:args.top])
+    display_table("HIGHEST POSITIVE FUNDING", pos_funding)
+    display_table("MOST NEGATIVE FUNDING", neg_funding)
 
 if __name__ == "__main__":
     main()
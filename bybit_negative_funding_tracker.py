@@ -6,19 +6,53 @@ import os
 import time
 import json
 import argparse
+import tempfile
 from datetime import datetime, timezone
-from typing import Dict, List, Optional, Tuple, Set
+from operator import itemgetter
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Set
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:  # orjson is optional, fall back to the stdlib parser
+    _json_loads = json.loads
 
 BYBIT_REST = os.getenv("BYBIT_REST", "https://api.bybit.com")
 COINGECKO_REST = os.getenv("COINGECKO_REST", "https://api.coingecko.com/api/v3")
 
 MARKET_CAP_MIN_USD = float(os.getenv("MARKET_CAP_MIN_USD", "100000000"))  # 100m
 REQ_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "15"))
+MAX_WORKERS = int(os.getenv("HTTP_WORKERS", "4"))  # concurrent CoinGecko batches in flight
+CACHE_DIR = os.getenv("FUNDING_TRACKER_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "funding_tracker"))
+COINS_LIST_TTL = float(os.getenv("COINS_LIST_TTL", "86400"))  # 24h
 USER_AGENT = "neg-funding-tracker/0.1.20"
 
+# Shared session so every call reuses pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.headers.update({"User-Agent": USER_AGENT})
+# Retries (honouring Retry-After on 429) happen inside the connection pool
+RETRY = Retry(total=3, backoff_factor=1.0, status_forcelist=(429, 500, 502, 503, 504),
+              allowed_methods={"GET"}, respect_retry_after_header=True, raise_on_status=False)
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=RETRY))
+
+class Row(NamedTuple):
+    """One result row for a negatively funded USDT pair."""
+    symbol: str
+    base: str
+    fundingRate: float
+    marketCapUSD: float
+    nextFundingTime: str
+    markPrice: float
+    turnover24h: float
+
+@lru_cache(maxsize=256)  # Funding times repeat across symbols in the same cycle
 def _iso_from_ms(ms: str) -> str:
     try:
         dt = datetime.fromtimestamp(int(ms) / 1000, tz=timezone.utc)
@@ -27,15 +61,36 @@ def _iso_from_ms(ms: str) -> str:
         return ""
 
 def _http_get(url: str, params: Optional[dict] = None, headers: Optional[dict] = None) -> dict:
-    h = {"User-Agent": USER_AGENT}
-    if headers:
-        h.update(headers)
-    r = requests.get(url, params=params or {}, headers=h, timeout=REQ_TIMEOUT)
+    r = SESSION.get(url, params=params or {}, headers=headers, timeout=REQ_TIMEOUT)
     r.raise_for_status()
-    return r.json()
+    return _json_loads(r.content)
+
+def get_coins_list_cached() -> List[dict]:
+    """Return CoinGecko's /coins/list, reusing a copy on disk for COINS_LIST_TTL seconds."""
+    path = os.path.join(CACHE_DIR, "coins_list.json")
+    try:
+        if os.path.getmtime(path) > time.time() - COINS_LIST_TTL:
+            with open(path, "rb") as f:
+                return _json_loads(f.read())
+    except (OSError, ValueError):
+        pass  # Missing or unreadable cache, fetch a fresh copy
 
-def bybit_get_all_linear_instruments() -> List[dict]:
-    """Fetch all linear instruments with pagination via nextPageCursor."""
+    coins_list = _http_get(f"{COINGECKO_REST}/coins/list")
+    if not coins_list:
+        return []  # Never cache an empty or failed response
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Unique temp file, so trackers running side by side never swap in a partial write
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=CACHE_DIR,
+                                         suffix=".tmp", delete=False) as f:
+            json.dump(coins_list, f)
+        os.replace(f.name, path)
+    except OSError as e:
+        print(f"Could not cache CoinGecko coins list: {e}")
+    return coins_list
+
+def bybit_get_all_linear_instruments(filt: Optional[Callable[[dict], bool]] = None) -> List[dict]:
+    """Fetch all linear instruments with pagination via nextPageCursor, keeping only those matching filt."""
     out: List[dict] = []
     cursor = None
 
@@ -47,68 +102,21 @@ def bybit_get_all_linear_instruments() -> List[dict]:
         resp = _http_get(f"{BYBIT_REST}/v5/market/instruments-info", params=params)
         
         if "result" in resp and "list" in resp["result"]:
-            out.extend(resp["result"]["list"])
+            out.extend(x for x in resp["result"]["list"] if filt is None or filt(x))
             
         # Check for next page
         if resp.get("result", {}).get("nextPageCursor"):
             cursor = resp["result"]["nextPageCursor"]
+            time.sleep(0.1)  # Rate limiting, only when another page follows
         else:
             break
-            
-        time.sleep(0.1)  # Rate limiting
         
     return out
 
-def bybit_get_funding_rates_batch(symbols: List[str]) -> Dict[str, Dict]:
-    """Get funding rates for multiple symbols in batches."""
-    funding_data = {}
-    
-    # Bybit API supports up to 10 symbols per request for funding rate
-    batch_size = 10
-    for i in range(0, len(symbols), batch_size):
-        batch = symbols[i:i + batch_size]
-        
-        # Get funding rates for all symbols in batch
-        params = {"category": "linear", "symbol": ",".join(batch)}
-        try:
-            resp = _http_get(f"{BYBIT_REST}/v5/market/funding/history", params=params)
-            
-            if "result" in resp and "list" in resp["result"]:
-                for item in resp["result"]["list"]:
-                    symbol = item.get("symbol")
-                    if symbol:
-                        funding_data[symbol] = item
-        except Exception as e:
-            print(f"Error fetching funding rates for batch: {e}")
-        
-        time.sleep(0.2)  # Rate limiting between batches
-    
-    return funding_data
-
-def bybit_get_tickers_batch(symbols: List[str]) -> Dict[str, Dict]:
-    """Get ticker data for multiple symbols in batches."""
-    ticker_data = {}
-    
-    # Bybit API supports up to 10 symbols per request for tickers
-    batch_size = 10
-    for i in range(0, len(symbols), batch_size):
-        batch = symbols[i:i + batch_size]
-        
-        params = {"category": "linear", "symbol": ",".join(batch)}
-        try:
-            resp = _http_get(f"{BYBIT_REST}/v5/market/tickers", params=params)
-            
-            if "result" in resp and "list" in resp["result"]:
-                for item in resp["result"]["list"]:
-                    symbol = item.get("symbol")
-                    if symbol:
-                        ticker_data[symbol] = item
-        except Exception as e:
-            print(f"Error fetching tickers for batch: {e}")
-        
-        time.sleep(0.2)  # Rate limiting between batches
-    
-    return ticker_data
+def bybit_get_tickers() -> List[dict]:
+    """Fetch all tickers at once to reduce individual API calls."""
+    resp = _http_get(f"{BYBIT_REST}/v5/market/tickers", params={"category": "linear"})
+    return resp.get("result", {}).get("list", [])
 
 def coingecko_get_market_data_batch(symbols: Set[str]) -> Dict[str, Dict]:
     """Get market data from CoinGecko for multiple symbols in minimal requests."""
@@ -116,52 +124,54 @@ def coingecko_get_market_data_batch(symbols: Set[str]) -> Dict[str, Dict]:
     
     try:
         # Get all coins list once
-        coins_list = _http_get(f"{COINGECKO_REST}/coins/list")
+        coins_list = get_coins_list_cached()
         print(f"Retrieved {len(coins_list)} coins from CoinGecko")
         
-        # Map symbols to coin IDs
-        symbol_to_id = {}
+        # Map every coin ID to its symbol; symbols are not unique (pegged and bridged
+        # tokens reuse them), so the right coin is picked by market cap below
+        id_to_symbol = {}
         for coin in coins_list:
             symbol = coin["symbol"].lower()
             if symbol in symbols:
-                symbol_to_id[symbol] = coin["id"]
+                id_to_symbol[coin["id"]] = symbol
         
-        print(f"Found {len(symbol_to_id)} symbols in CoinGecko")
+        print(f"Found {len(set(id_to_symbol.values()))} symbols in CoinGecko")
         
-        # Batch by 30 coin IDs per request (CoinGecko limit)
-        coin_ids = list(symbol_to_id.values())
+        # Batch by 250 coin IDs per request (CoinGecko's per_page maximum)
+        coin_ids = list(id_to_symbol)
         market_data = {}
         
-        batch_size = 30  # CoinGecko's limit per request
-        for i in range(0, len(coin_ids), batch_size):
-            batch_ids = coin_ids[i:i + batch_size]
-            
+        batch_size = 250
+        batches = [coin_ids[i:i + batch_size] for i in range(0, len(coin_ids), batch_size)]
+        
+        def fetch(batch_ids: List[str]) -> List[dict]:
             params = {
                 "ids": ",".join(batch_ids),
                 "vs_currency": "usd",
-                "sparkline": "false"
+                "sparkline": "false",
+                "per_page": batch_size,
+                "page": 1
             }
-            
             try:
-                data = _http_get(f"{COINGECKO_REST}/coins/markets", params=params)
-                
+                return _http_get(f"{COINGECKO_REST}/coins/markets", params=params)
+            except Exception as e:
+                print(f"Error fetching CoinGecko batch: {e}")
+                return []
+        
+        # The public rate limit is per minute, so the few batches can be in flight at once
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+            for n, data in enumerate(pool.map(fetch, batches), 1):
                 for coin_data in data:
-                    coin_id = coin_data.get("id")
                     # Find which symbol this coin_id corresponds to
-                    for symbol, cid in symbol_to_id.items():
-                        if cid == coin_id:
-                            market_data[symbol] = coin_data
-                            break
+                    symbol = id_to_symbol.get(coin_data.get("id"))
+                    if not symbol:
+                        continue
+                    # Keep the largest coin when several share a symbol
+                    current = market_data.get(symbol)
+                    if current is None or (coin_data.get("market_cap") or 0) > (current.get("market_cap") or 0):
+                        market_data[symbol] = coin_data
                 
-                print(f"Processed batch {i//batch_size + 1}/{(len(coin_ids)-1)//batch_size + 1}")
-                
-                # Rate limiting for CoinGecko (max 10-30 calls per minute)
-                if i + batch_size < len(coin_ids):
-                    time.sleep(6)  # Wait 6 seconds between batches
-                    
-            except Exception as e:
-                print(f"Error fetching CoinGecko batch: {e}")
-                continue
+                print(f"Processed batch {n}/{len(batches)}")
         
         return market_data
         
@@ -169,6 +179,9 @@ def coingecko_get_market_data_batch(symbols: Set[str]) -> Dict[str, Dict]:
         print(f"Error getting CoinGecko data: {e}")
         return {}
 
+# Precompiled row template; the color codes wrap the padded funding rate so columns stay aligned
+ROW_FMT = "{:<3} {:<12} {:<8} {}{:<12.6f}{} {:<20} {:<25} {:<12.6f} {:<15.6f}".format
+
 def main():
     parser = argparse.ArgumentParser(description="Track negative funding rates on Bybit")
     parser.add_argument("--min-cap", type=float, default=MARKET_CAP_MIN_USD,
@@ -181,30 +194,33 @@ def main():
                        help="Show verbose output")
     args = parser.parse_args()
 
+    # Local alias for the per-ticker conversions below; `or 0` also covers the
+    # empty strings and nulls Bybit sends for fields without a value
+    _float = float
+
     print(f"UTC {datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')} | min_cap={args.min_cap:,.0f} USD")
     print("=" * 80)
     
     # Step 1: Get all linear instruments
+    # Filter for USDT pairs while paging, so other quote currencies are never kept
     print("Fetching all linear instruments from Bybit...")
-    instruments = bybit_get_all_linear_instruments()
-    print(f"Found {len(instruments)} linear instruments")
-    
-    # Filter for USDT pairs
-    usdt_instruments = [instr for instr in instruments if instr.get("symbol", "").endswith("USDT")]
-    print(f"Filtered to {len(usdt_instruments)} USDT pairs")
+    usdt_instruments = bybit_get_all_linear_instruments(filt=lambda i: i.get("symbol", "").endswith("USDT"))
+    print(f"Found {len(usdt_instruments)} USDT linear instruments")
     
-    # Step 2: Get funding rates for all USDT pairs in batches
-    symbols = [instr["symbol"] for instr in usdt_instruments]
-    print(f"Fetching funding rates for {len(symbols)} symbols...")
-    funding_data = bybit_get_funding_rates_batch(symbols)
-    print(f"Retrieved funding rates for {len(funding_data)} symbols")
+    # Step 2: Get all tickers in one call (includes funding rates & prices)
+    print(f"Fetching tickers for {len(usdt_instruments)} symbols...")
+    ticker_by_symbol = {t["symbol"]: t for t in bybit_get_tickers()}
+    print(f"Retrieved {len(ticker_by_symbol)} tickers")
     
     # Step 3: Filter for negative funding rates
-    negative_symbols = []
-    for symbol, data in funding_data.items():
-        funding_rate = float(data.get("fundingRate", 0))
+    ticker_data = {}
+    for instr in usdt_instruments:
+        symbol = instr["symbol"]
+        ticker = ticker_by_symbol.get(symbol, {})
+        funding_rate = _float(ticker.get("fundingRate") or 0)
         if funding_rate < 0:  # Negative funding
-            negative_symbols.append(symbol)
+            ticker_data[symbol] = ticker
+    negative_symbols = list(ticker_data)
     
     print(f"Found {len(negative_symbols)} symbols with negative funding rates")
     
@@ -212,11 +228,7 @@ def main():
         print("No negative funding rates found!")
         return
     
-    # Step 4: Get ticker data for negative symbols in batches
-    print(f"Fetching ticker data for {len(negative_symbols)} symbols...")
-    ticker_data = bybit_get_tickers_batch(negative_symbols)
-    
-    # Step 5: Get CoinGecko data for unique base coins
+    # Step 4: Get CoinGecko data for unique base coins
     base_coins = set()
     symbol_to_base = {}
     for symbol in negative_symbols:
@@ -225,7 +237,7 @@ def main():
         base_coins.add(base_coin.lower())  # CoinGecko uses lowercase
         symbol_to_base[symbol] = base_coin
     
-    # Step 6: Get market cap data from CoinGecko (if not skipping)
+    # Step 5: Get market cap data from CoinGecko (if not skipping)
     market_cap_data = {}
     if not args.skip_market_cap:
         market_cap_data = coingecko_get_market_data_batch(base_coins)
@@ -233,18 +245,17 @@ def main():
     else:
         print("Skipping market cap filtering as requested")
     
-    # Step 7: Process and compile results
+    # Step 6: Process and compile results
     results = []
     
     for symbol in negative_symbols:
         base_coin = symbol_to_base[symbol]
-        funding_info = funding_data.get(symbol, {})
-        ticker_info = ticker_data.get(symbol, {})
+        ticker_info = ticker_data[symbol]
         
-        funding_rate = float(funding_info.get("fundingRate", 0))
-        mark_price = float(ticker_info.get("markPrice", 0))
-        turnover24h = float(ticker_info.get("turnover24h", 0))
-        next_funding_time = funding_info.get("fundingRateTimestamp", "")
+        funding_rate = _float(ticker_info.get("fundingRate") or 0)
+        mark_price = _float(ticker_info.get("markPrice") or 0)
+        turnover24h = _float(ticker_info.get("turnover24h") or 0)
+        next_funding_time = ticker_info.get("nextFundingTime", "")
         
         # Get market cap
         market_cap = 0
@@ -259,23 +270,24 @@ def main():
             # If skipping market cap check, set a placeholder value
             market_cap = float('inf')
         
-        results.append({
-            "symbol": symbol,
-            "base": base_coin,
-            "fundingRate": funding_rate,
-            "marketCapUSD": market_cap,
-            "nextFundingTime": _iso_from_ms(next_funding_time) if next_funding_time else "",
-            "markPrice": mark_price,
-            "turnover24h": turnover24h
-        })
+        # Keep the rate up front so the sort compares plain floats
+        results.append((funding_rate, Row(
+            symbol=symbol,
+            base=base_coin,
+            fundingRate=funding_rate,
+            marketCapUSD=market_cap,
+            nextFundingTime=_iso_from_ms(next_funding_time) if next_funding_time else "",
+            markPrice=mark_price,
+            turnover24h=turnover24h
+        )))
     
-    # Step 8: Sort by most negative funding rate
-    results.sort(key=lambda x: x["fundingRate"])
+    # Step 7: Sort by most negative funding rate
+    results.sort(key=itemgetter(0))
     
     # Take top N results
-    results = results[:args.top]
+    results = [row for _, row in results[:args.top]]
     
-    # Step 9: Display results
+    # Step 8: Display results
     print("\n" + "=" * 120)
     print(f"TOP {len(results)} NEGATIVE FUNDING RATES")
     print("=" * 120)
@@ -286,23 +298,18 @@ def main():
     
     # Print data
     for idx, r in enumerate(results, 1):
-        if r['marketCapUSD'] == float('inf'):
+        if r.marketCapUSD == float('inf'):
             market_cap_display = "N/A"
-        elif r['marketCapUSD'] == 0:
+        elif r.marketCapUSD == 0:
             market_cap_display = "Not Found"
         else:
-            market_cap_display = f"${r['marketCapUSD']:,.0f}"
+            market_cap_display = f"${r.marketCapUSD:,.0f}"
         
-        funding_rate_display = f"{r['fundingRate']:.6f}"
-        if r['fundingRate'] < -0.001:
-            funding_rate_display = f"\033[91m{funding_rate_display}\033[0m"  # Red for very negative
+        # Red for very negative
+        color, reset = ("\033[91m", "\033[0m") if r.fundingRate < -0.001 else ("", "")
         
-        print(f"{idx:<3} {r['symbol']:<12} {r['base']:<8} "
-              f"{funding_rate_display:<12} "
-              f"{market_cap_display:<20} "
-              f"{r['nextFundingTime']:<25} "
-              f"{r['markPrice']:<12.6f} "
-              f"{r['turnover24h']:<15.6f}")
+        print(ROW_FMT(idx, r.symbol, r.base, color, r.fundingRate, reset,
+                      market_cap_display, r.nextFundingTime, r.markPrice, r.turnover24h))
 
 if __name__ == "__main__":
     try:
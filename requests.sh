@@ -1 +1 @@
-pip install requests
\ No newline at end of file
+pip install requests brotli
\ No newline at end of file